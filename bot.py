@@ -1,12 +1,24 @@
 import os
+import asyncio
+import functools
+import hashlib
 import logging
-import sqlite3
+import re
+import signal
+import threading
+import aiosqlite
+import time
 import uuid
-from html import escape
-from yookassa import Payment, Configuration
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler, JobQueue
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 import ollama
 from dotenv import load_dotenv
 
@@ -22,58 +34,242 @@ logger = logging.getLogger(__name__)
 
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+_TOKEN_RE = re.compile(r'^\d+:[A-Za-z0-9_-]{35}$')
 
 
-Configuration.account_id = os.getenv('YOOKASSA_SHOP_ID', '...')
-Configuration.secret_key = os.getenv('YOOKASSA_SECRET_KEY', '...')
+YOOKASSA_API_URL = 'https://api.yookassa.ru/v3/payments'
+YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID', '...')
+YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY', '...')
+
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+
+_LETTER_TABLE = str.maketrans({
+    **{c: 'R' for c in 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ'},
+    **{c: 'E' for c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'}
+})
+
+
+def count_letters(text: str):
+    classified = text.translate(_LETTER_TABLE)
+    return classified.count('R'), classified.count('E')
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+
+def escape_html(text: str) -> str:
+    if '&' in text or '<' in text or '>' in text:
+        return text.translate(_HTML_ESCAPE_TABLE)
+    return text
+
+CREATE_PAYMENT_PREFIX = "create_payment_"
+CHECK_PAYMENT_PREFIX = "check_payment_"
+CANCEL_ORDER_PREFIX = "cancel_order_"
+
+Pack = namedtuple('Pack', 'id tokens price label button_text callback_data description')
+
+_WELCOME_TEMPLATE = (
+    "👋 Привет, {first_name}!\n\n"
+    "🤖 <b>Добро пожаловать в AI-бота с автоматической оплатой через YooKassa!</b>\n\n"
+    "🎁 <b>Бесплатный бонус:</b> 100 токенов\n"
+    "💸 <b>Стоимость запроса:</b> {cost} токенов\n\n"
+    "<b>Основные команды:</b>\n"
+    "/buy - Купить токены (YooKassa)\n"
+    "/balance - Проверить баланс\n"
+    "/history - История платежей\n"
+    "/clear - Очистить историю диалога\n"
+    "/menu - Главное меню\n\n"
+    "💡 Просто напишите сообщение для общения с ИИ!"
+)
+
+_HELP_TEXT = (
+    "🤖 <b>Помощь по боту</b>\n\n"
+    "<b>Как это работает:</b>\n"
+    "1. У вас есть токены (начальный бонус: 100)\n"
+    "2. Каждый запрос к ИИ стоит 10 токенов\n"
+    "3. Пополняйте баланс через YooKassa\n\n"
+    "<b>Команды:</b>\n"
+    "/start - Начало работы\n"
+    "/buy - Купить токены\n"
+    "/balance - Баланс\n"
+    "/history - История платежей\n"
+    "/clear - Очистить историю диалога\n"
+    "/menu - Главное меню\n\n"
+    "<b>Оплата:</b>\n"
+    "• Принимаем карты, Яндекс.Деньги, СБП\n"
+    "• Мгновенное зачисление токенов\n"
+    "• Безопасно через YooKassa"
+)
+
+_MENU_TEXT = "🏠 <b>Главное меню</b>\n\nВыберите действие:"
+
+_BUY_TEXT = (
+    "🛒 <b>Покупка токенов через YooKassa</b>\n\n"
+    "<b>Выберите пакет:</b>\n"
+    "• Безопасная оплата картой, Яндекс.Деньги, СБП\n"
+    "• Мгновенное зачисление токенов\n"
+    "• Автоматическая проверка платежа\n"
+)
 
 class YooKassaBot:
     def __init__(self, telegram_token: str):
-        self.application = Application.builder().token(telegram_token).build()
-        self.conn = sqlite3.connect('tokens.db', check_same_thread=False)
-        self.init_db()
+        self.application = (
+            Application.builder()
+            .token(telegram_token)
+            .connection_pool_size(256)
+            .pool_timeout(30)
+            .get_updates_connection_pool_size(1)
+            .concurrent_updates(True)
+            .build()
+        )
+        self.conn = None
+        self.http = None
+        self._db_lock = asyncio.Lock()
+        self._register_queue = asyncio.Queue()
+        self._register_task = None
+        self._sql_insert_order = '''
+            INSERT INTO orders (order_id, user_id, pack_id, tokens, price, yookassa_payment_id, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'created')
+        '''
+        self._sql_insert_payment = '''
+            INSERT INTO payments (user_id, amount, tokens_added, yookassa_id, status, description)
+            VALUES (?, ?, ?, ?, 'pending', ?)
+        '''
+        self._sql_user_info = 'SELECT tokens, total_spent FROM users WHERE user_id = ?'
+        self._sql_register_user = 'INSERT OR IGNORE INTO users (user_id, tokens) VALUES (?, 100)'
+        self._sql_debit = '''
+            UPDATE users SET tokens = tokens - ?
+            WHERE user_id = ? AND tokens >= ?
+            RETURNING tokens, total_spent
+        '''
         
         self.COST_PER_REQUEST = 10 
-        self.conversation_history = {}  
+        self.OLLAMA_TIMEOUT = 30
+        self.USER_CACHE_SIZE = 10_000
+        self._user_cache = OrderedDict()
+        self.POLL_INTERVAL_MIN = 30
+        self.POLL_INTERVAL_MAX = 300
+        self._poll_interval = self.POLL_INTERVAL_MIN
+        self.HISTORY_LIMIT = 20
+        self.HISTORY_CACHE_SIZE = 1_000
+        self.conversation_history = OrderedDict()
         
-        self.token_packs = {
-            'small': {'tokens': 1000, 'price': 100.00, 'label': '🔹 1,000 токенов'},
-            'medium': {'tokens': 5000, 'price': 450.00, 'label': '🔸 5,000 токенов'},
-            'large': {'tokens': 15000, 'price': 1200.00, 'label': '🔶 15,000 токенов'},
-            'premium': {'tokens': 50000, 'price': 3500.00, 'label': '💎 50,000 токенов'}
-        }
+        self.token_packs = {p.id: p for p in (
+            Pack('small', 1000, 100.00, '🔹 1,000 токенов', '🔹 1,000 токенов - 100₽',
+                 CREATE_PAYMENT_PREFIX + 'small', 'Покупка 1,000 токенов'),
+            Pack('medium', 5000, 450.00, '🔸 5,000 токенов', '🔸 5,000 токенов - 450₽',
+                 CREATE_PAYMENT_PREFIX + 'medium', 'Покупка 5,000 токенов'),
+            Pack('large', 15000, 1200.00, '🔶 15,000 токенов', '🔶 15,000 токенов - 1200₽',
+                 CREATE_PAYMENT_PREFIX + 'large', 'Покупка 15,000 токенов'),
+            Pack('premium', 50000, 3500.00, '💎 50,000 токенов', '💎 50,000 токенов - 3500₽',
+                 CREATE_PAYMENT_PREFIX + 'premium', 'Покупка 50,000 токенов')
+        )}
         
-        self.ollama_available = self.check_ollama()
+        self.ollama_available = False
+        self.available_models = set()
+        self.INFERENCE_WORKERS = 4
+        self.infer_q = asyncio.Queue(maxsize=256)
+        self._inference_tasks = []
+        self._ollama_pool = ThreadPoolExecutor(max_workers=self.INFERENCE_WORKERS)
+        self._last_good_model = 'mistral'
 
         self.setup_handlers()
+        self.setup_callbacks()
+        self.setup_keyboards()
+
+        self.schedule_payment_check(10)
+
+    async def post_init(self, application: Application):
+        ollama_result, db_result = await asyncio.gather(self.check_ollama(), self.open_db(), return_exceptions=True)
+        if isinstance(db_result, BaseException):
+            raise db_result
+        self.ollama_available = ollama_result is True
+
+        self._register_task = asyncio.create_task(self.register_writer())
+        self._inference_tasks = [asyncio.create_task(self.inference_worker()) for _ in range(self.INFERENCE_WORKERS)]
+        self.http = httpx.AsyncClient(
+            auth=(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY),
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            timeout=15.0
+        )
 
-        if self.application.job_queue:
-            self.application.job_queue.run_repeating(
-                self.check_pending_payments,
-                interval=30,  
-                first=10
-            )
-
-    def init_db(self):
-        cursor = self.conn.cursor()
+    async def open_db(self):
+        self.conn = await aiosqlite.connect('tokens.db', isolation_level='IMMEDIATE')
+        async with self.conn.execute("PRAGMA journal_mode=WAL") as cursor:
+            (journal_mode,) = await cursor.fetchone()
+        if journal_mode != 'wal':
+            logger.warning("Не удалось включить WAL, режим журнала: %s", journal_mode)
+        await self.conn.executescript(
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA busy_timeout=5000;"
+            "PRAGMA cache_size=-65536;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA mmap_size=268435456;"
+        )
+        await self.init_db()
+        await self.conn.execute_fetchall(self._sql_user_info, ('',))
+        await self.warm_user_cache()
+
+    async def warm_user_cache(self):
+        rows = await self.conn.execute_fetchall('''
+            SELECT u.user_id, u.tokens, u.total_spent 
+            FROM users u 
+            JOIN (
+                SELECT user_id, MAX(ts) AS last_ts 
+                FROM history 
+                GROUP BY user_id 
+                ORDER BY last_ts DESC 
+                LIMIT ?
+            ) recent ON recent.user_id = u.user_id 
+            ORDER BY recent.last_ts
+        ''', (self.USER_CACHE_SIZE,))
+
+        for user_id, tokens, total_spent in rows:
+            self.cache_user(user_id, (tokens, total_spent))
+        logger.info("Кэш пользователей прогрет: %s", len(rows))
+
+    async def post_shutdown(self, application: Application):
+        if self._register_task:
+            self._register_task.cancel()
+        if self.conn:
+            await self.conn.close()
+        if self.http:
+            await self.http.aclose()
+        self._ollama_pool.shutdown(wait=False, cancel_futures=True)
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._db_lock:
+            try:
+                yield self.conn
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            else:
+                await self.conn.commit()
 
-        cursor.execute('DROP TABLE IF EXISTS users')
-        cursor.execute('DROP TABLE IF EXISTS payments')
-        cursor.execute('DROP TABLE IF EXISTS orders')
+    async def init_db(self):
+        await self.conn.execute('BEGIN IMMEDIATE')
+        legacy_tables = await self.rename_text_user_tables()
 
-        cursor.execute('''
-            CREATE TABLE users (
-                user_id TEXT PRIMARY KEY,
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
                 tokens INTEGER DEFAULT 100,
                 total_spent REAL DEFAULT 0,
                 registered TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
 
-        cursor.execute('''
-            CREATE TABLE payments (
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
                 payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
+                user_id INTEGER,
                 amount REAL,
                 tokens_added INTEGER,
                 yookassa_id TEXT,
@@ -84,10 +280,10 @@ class YooKassaBot:
             )
         ''')
 
-        cursor.execute('''
-            CREATE TABLE orders (
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
                 order_id TEXT PRIMARY KEY,
-                user_id TEXT,
+                user_id INTEGER,
                 pack_id TEXT,
                 tokens INTEGER,
                 price REAL,
@@ -96,19 +292,83 @@ class YooKassaBot:
                 created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        self.conn.commit()
-        logger.info("База данных пересоздана с правильной структурой")
 
-    def check_ollama(self):
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS prompts (
+                hash BLOB PRIMARY KEY,
+                text TEXT
+            )
+        ''')
+
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                user_id INTEGER,
+                ts INTEGER,
+                role TEXT,
+                prompt_hash BLOB
+            )
+        ''')
+
+        for table in legacy_tables:
+            columns = [row[1] for row in await self.conn.execute_fetchall(f'PRAGMA table_info({table}_old)')]
+            selected = ['CAST(user_id AS INTEGER)' if column == 'user_id' else column for column in columns]
+            await self.conn.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(selected)} FROM {table}_old"
+            )
+            await self.conn.execute(f'DROP TABLE {table}_old')
+
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id, created DESC)')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_yookassa ON orders(yookassa_payment_id)')
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders(status, created) WHERE status = 'created'")
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_history_user_ts ON history(user_id, ts DESC)')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_history_prompt ON history(prompt_hash)')
+
+        await self.conn.commit()
+        logger.info("База данных инициализирована")
+
+    async def rename_text_user_tables(self):
+        columns = {row[1]: row[2] for row in await self.conn.execute_fetchall('PRAGMA table_info(users)')}
+        if columns.get('user_id') != 'TEXT':
+            return []
+
+        renamed = []
+        for table in ('users', 'payments', 'orders', 'history'):
+            exists = await self.conn.execute_fetchall(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            )
+            if exists:
+                await self.conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+                renamed.append(table)
+        logger.info("Идентификаторы пользователей переводятся в INTEGER: %s", ', '.join(renamed))
+        return renamed
+
+    async def check_ollama(self):
         try:
-            ollama.list()
-            logger.info("Ollama доступен")
+            listing = await asyncio.to_thread(ollama.list)
+            self.available_models = {m.model.split(':')[0] for m in listing.models}
+            logger.info("Ollama доступен, модели: %s", ', '.join(sorted(self.available_models)))
             return True
         except Exception as e:
-            logger.error(f"Ollama недоступен: {e}")
+            self.available_models = set()
+            logger.error("Ollama недоступен: %s", e)
             return False
 
+    def schedule_payment_check(self, when: float, sooner_only: bool = False):
+        job_queue = self.application.job_queue
+        if not job_queue:
+            return
+
+        jobs = job_queue.get_jobs_by_name('check_pending_payments')
+        if sooner_only:
+            deadline = datetime.now(timezone.utc) + timedelta(seconds=when)
+            if any(job.next_t and job.next_t <= deadline for job in jobs):
+                return
+
+        for job in jobs:
+            job.schedule_removal()
+
+        job_queue.run_once(self.check_pending_payments, when=when, name='check_pending_payments')
+
     def setup_handlers(self):
         self.application.add_handler(CommandHandler("start", self.start))
         self.application.add_handler(CommandHandler("help", self.help_command))
@@ -122,90 +382,106 @@ class YooKassaBot:
 
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
 
-    async def start(self, update: Update, context: CallbackContext):
-        user = update.effective_user
-        user_id = str(user.id)
+    def setup_callbacks(self):
+        self._exact = {
+            "menu": self._menu_cb,
+            "balance": self._balance_cb,
+            "buy": self._buy_cb,
+            "history": self._history_cb,
+            "help": self._help_cb,
+            "ask_question": self._ask_question_cb,
+            "clear_history": self._clear_history_cb
+        }
+        self._prefix = [
+            (CREATE_PAYMENT_PREFIX, self._create_payment_cb),
+            (CHECK_PAYMENT_PREFIX, self._check_payment_cb),
+            (CANCEL_ORDER_PREFIX, self._cancel_order_cb)
+        ]
 
-        self.register_user(user_id)
+    def setup_keyboards(self):
+        back_button = InlineKeyboardButton("🔙 Назад", callback_data="menu")
 
-        if user_id in self.conversation_history:
-            del self.conversation_history[user_id]
-        
-        welcome_text = (
-            f"👋 Привет, {user.first_name}!\n\n"
-            "🤖 <b>Добро пожаловать в AI-бота с автоматической оплатой через YooKassa!</b>\n\n"
-            f"🎁 <b>Бесплатный бонус:</b> 100 токенов\n"
-            f"💸 <b>Стоимость запроса:</b> {self.COST_PER_REQUEST} токенов\n\n"
-            "<b>Основные команды:</b>\n"
-            "/buy - Купить токены (YooKassa)\n"
-            "/balance - Проверить баланс\n"
-            "/history - История платежей\n"
-            "/clear - Очистить историю диалога\n"
-            "/menu - Главное меню\n\n"
-            "💡 Просто напишите сообщение для общения с ИИ!"
-        )
-        
-        keyboard = [
+        self._kb_start = InlineKeyboardMarkup([
             [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
             [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
             [InlineKeyboardButton("📋 Меню", callback_data="menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        ])
+
+        self._kb_menu = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🤖 Задать вопрос", callback_data="ask_question")],
+            [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
+            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
+            [InlineKeyboardButton("📜 История платежей", callback_data="history")],
+            [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
+            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
+        ])
+
+        self._kb_balance = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
+            [InlineKeyboardButton("📜 История платежей", callback_data="history")],
+            [InlineKeyboardButton("📋 Меню", callback_data="menu")]
+        ])
+
+        self._kb_history = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
+            [InlineKeyboardButton("📋 Главное меню", callback_data="menu")]
+        ])
+
+        self._kb_paid = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 Главное меню", callback_data="menu")],
+            [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
+            [InlineKeyboardButton("🤖 Задать вопрос", callback_data="ask_question")]
+        ])
+
+        self._kb_answer = InlineKeyboardMarkup([
+            [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
+            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
+            [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
+            [InlineKeyboardButton("🤖 Новый вопрос", callback_data="ask_question")],
+            [InlineKeyboardButton("📋 Главное меню", callback_data="menu")]
+        ])
+
+        self._buy_keyboard_rows = [
+            [InlineKeyboardButton(pack.button_text, callback_data=pack.callback_data)]
+            for pack in self.token_packs.values()
+        ] + [[back_button]]
+        self._kb_buy = InlineKeyboardMarkup(self._buy_keyboard_rows)
+
+    async def start(self, update: Update, context: CallbackContext):
+        user = update.effective_user
+        user_id = user.id
+
+        await self.register_user(user_id)
+        await self.clear_user_history(user_id)
+        
+        welcome_text = _WELCOME_TEMPLATE.format(first_name=user.first_name, cost=self.COST_PER_REQUEST)
+        
+        reply_markup = self._kb_start
         
         await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     async def clear_history(self, update: Update, context: CallbackContext):
-        user_id = str(update.effective_user.id)
+        user_id = update.effective_user.id
         
-        if user_id in self.conversation_history:
-            del self.conversation_history[user_id]
+        if await self.clear_user_history(user_id):
             await update.message.reply_text("✅ История диалога очищена!")
         else:
             await update.message.reply_text("📭 История диалога уже пуста!")
 
     async def help_command(self, update: Update, context: CallbackContext):
-        help_text = (
-            "🤖 <b>Помощь по боту</b>\n\n"
-            "<b>Как это работает:</b>\n"
-            "1. У вас есть токены (начальный бонус: 100)\n"
-            "2. Каждый запрос к ИИ стоит 10 токенов\n"
-            "3. Пополняйте баланс через YooKassa\n\n"
-            "<b>Команды:</b>\n"
-            "/start - Начало работы\n"
-            "/buy - Купить токены\n"
-            "/balance - Баланс\n"
-            "/history - История платежей\n"
-            "/clear - Очистить историю диалога\n"
-            "/menu - Главное меню\n\n"
-            "<b>Оплата:</b>\n"
-            "• Принимаем карты, Яндекс.Деньги, СБП\n"
-            "• Мгновенное зачисление токенов\n"
-            "• Безопасно через YooKassa"
-        )
-        
-        await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
+        await update.message.reply_text(_HELP_TEXT, parse_mode=ParseMode.HTML)
 
     async def show_menu(self, update: Update, context: CallbackContext):
-        menu_text = "🏠 <b>Главное меню</b>\n\nВыберите действие:"
-        
-        keyboard = [
-            [InlineKeyboardButton("🤖 Задать вопрос", callback_data="ask_question")],
-            [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
-            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
-            [InlineKeyboardButton("📜 История платежей", callback_data="history")],
-            [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._kb_menu
 
         if update.message:
-            await update.message.reply_text(menu_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            await update.message.reply_text(_MENU_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         elif update.callback_query:
-            await update.callback_query.edit_message_text(menu_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            await update.callback_query.edit_message_text(_MENU_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     async def show_balance(self, update: Update, context: CallbackContext):
-        user_id = str(update.effective_user.id)
-        user_info = self.get_user_info(user_id)
+        user_id = update.effective_user.id
+        user_info = await self.get_user_info(user_id)
         
         if not user_info:
             if update.message:
@@ -224,12 +500,7 @@ class YooKassaBot:
             f"🛒 <b>Пополнить:</b> /buy"
         )
         
-        keyboard = [
-            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
-            [InlineKeyboardButton("📜 История платежей", callback_data="history")],
-            [InlineKeyboardButton("📋 Меню", callback_data="menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._kb_balance
 
         if update.message:
             await update.message.reply_text(balance_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -237,34 +508,18 @@ class YooKassaBot:
             await update.callback_query.edit_message_text(balance_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     async def buy_tokens(self, update: Update, context: CallbackContext):
-        buy_text = (
-            "🛒 <b>Покупка токенов через YooKassa</b>\n\n"
-            "<b>Выберите пакет:</b>\n"
-            "• Безопасная оплата картой, Яндекс.Деньги, СБП\n"
-            "• Мгновенное зачисление токенов\n"
-            "• Автоматическая проверка платежа\n"
-        )
-        
-        keyboard = []
-        for pack_id, pack in self.token_packs.items():
-            keyboard.append([InlineKeyboardButton(
-                f"{pack['label']} - {pack['price']:.0f}₽",
-                callback_data=f"create_payment_{pack_id}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._kb_buy
 
         if update.message:
-            await update.message.reply_text(buy_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            await update.message.reply_text(_BUY_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         elif update.callback_query:
-            await update.callback_query.edit_message_text(buy_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            await update.callback_query.edit_message_text(_BUY_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     async def create_yookassa_payment(self, update: Update, pack_id: str):
         query = update.callback_query
         
         user = update.effective_user
-        user_id = str(user.id)
+        user_id = user.id
         
         pack = self.token_packs.get(pack_id)
         if not pack:
@@ -274,9 +529,9 @@ class YooKassaBot:
         order_id = str(uuid.uuid4())
         
         try:
-            payment = Payment.create({
+            payment = await self.create_payment({
                 "amount": {
-                    "value": f"{pack['price']:.2f}",
+                    "value": f"{pack.price:.2f}",
                     "currency": "RUB"
                 },
                 "confirmation": {
@@ -284,59 +539,51 @@ class YooKassaBot:
                     "return_url": "https://t.me/"
                 },
                 "capture": True,
-                "description": f"Покупка {pack['tokens']:,} токенов в AI боте",
+                "description": f"Покупка {pack.tokens:,} токенов в AI боте",
                 "metadata": {
                     "user_id": user_id,
                     "order_id": order_id,
                     "pack_id": pack_id,
-                    "tokens": pack['tokens'],
+                    "tokens": pack.tokens,
                     "username": user.username or user.first_name
                 }
-            }, str(uuid.uuid4()))
-            
-            logger.info(f"Создан платеж YooKassa: {payment.id} для пользователя {user_id}")
-
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO orders (order_id, user_id, pack_id, tokens, price, yookassa_payment_id, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                order_id,
-                user_id,
-                pack_id,
-                pack['tokens'],
-                pack['price'],
-                payment.id,
-                'created'
-            ))
-
-            cursor.execute('''
-                INSERT INTO payments (user_id, amount, tokens_added, yookassa_id, status, description)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                pack['price'],
-                pack['tokens'],
-                payment.id,
-                'pending',
-                f"Покупка {pack['tokens']:,} токенов"
-            ))
+            })
             
-            self.conn.commit()
+            logger.info("Создан платеж YooKassa: %s для пользователя %s", payment['id'], user_id)
+
+            async with self.transaction() as conn:
+                await conn.execute(self._sql_insert_order, (
+                    order_id,
+                    user_id,
+                    pack_id,
+                    pack.tokens,
+                    pack.price,
+                    payment['id']
+                ))
+                await conn.execute(self._sql_insert_payment, (
+                    user_id,
+                    pack.price,
+                    pack.tokens,
+                    payment['id'],
+                    pack.description
+                ))
+
+            self._poll_interval = self.POLL_INTERVAL_MIN
+            self.schedule_payment_check(self._poll_interval, sooner_only=True)
 
             payment_text = (
-                f"💳 <b>Оплата {pack['label']}</b>\n\n"
-                f"💰 <b>Сумма:</b> {pack['price']:.0f} руб.\n"
-                f"🪙 <b>Вы получите:</b> {pack['tokens']:,} токенов\n\n"
+                f"💳 <b>Оплата {pack.label}</b>\n\n"
+                f"💰 <b>Сумма:</b> {pack.price:.0f} руб.\n"
+                f"🪙 <b>Вы получите:</b> {pack.tokens:,} токенов\n\n"
                 f"🆔 <b>Номер заказа:</b> <code>{order_id}</code>\n\n"
                 "⏳ <b>Ссылка на оплату действует 24 часа</b>\n\n"
                 "Нажмите кнопку ниже для оплаты:"
             )
             
             keyboard = [
-                [InlineKeyboardButton("💳 Оплатить картой/СБП", url=payment.confirmation.confirmation_url)],
-                [InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_payment_{order_id}")],
-                [InlineKeyboardButton("❌ Отменить заказ", callback_data=f"cancel_order_{order_id}")]
+                [InlineKeyboardButton("💳 Оплатить картой/СБП", url=payment['confirmation']['confirmation_url'])],
+                [InlineKeyboardButton("🔄 Проверить оплату", callback_data=CHECK_PAYMENT_PREFIX + order_id)],
+                [InlineKeyboardButton("❌ Отменить заказ", callback_data=CANCEL_ORDER_PREFIX + order_id)]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -349,16 +596,29 @@ class YooKassaBot:
             await query.answer("✅ Платеж создан!")
             
         except Exception as e:
-            logger.error(f"Ошибка создания платежа YooKassa: {e}", exc_info=True)
+            logger.error("Ошибка создания платежа YooKassa: %s", e, exc_info=True)
             await query.answer("❌ Ошибка создания платежа. Попробуйте позже.")
 
+    async def create_payment(self, payload: dict) -> dict:
+        response = await self.http.post(
+            YOOKASSA_API_URL,
+            json=payload,
+            headers={'Idempotence-Key': str(uuid.uuid4())}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def fetch_payment(self, payment_id: str) -> dict:
+        response = await self.http.get(f"{YOOKASSA_API_URL}/{payment_id}")
+        response.raise_for_status()
+        return response.json()
+
     async def check_payment_status(self, update: Update, order_id: str):
         query = update.callback_query
         await query.answer()
         
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT yookassa_payment_id, status FROM orders WHERE order_id = ?', (order_id,))
-        order = cursor.fetchone()
+        async with self.conn.execute('SELECT yookassa_payment_id, status FROM orders WHERE order_id = ?', (order_id,)) as cursor:
+            order = await cursor.fetchone()
         
         if not order:
             await query.answer("❌ Заказ не найден")
@@ -371,9 +631,9 @@ class YooKassaBot:
             return
         
         try:
-            payment = Payment.find_one(payment_id)
+            payment = await self.fetch_payment(payment_id)
             
-            if payment.status == 'succeeded':
+            if payment['status'] == 'succeeded':
                 await self.process_successful_payment(payment_id, order_id)
                 
                 success_text = (
@@ -383,12 +643,7 @@ class YooKassaBot:
                     "🤖 Задавайте вопросы!"
                 )
                 
-                keyboard = [
-                    [InlineKeyboardButton("📋 Главное меню", callback_data="menu")],
-                    [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
-                    [InlineKeyboardButton("🤖 Задать вопрос", callback_data="ask_question")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = self._kb_paid
                 
                 await query.edit_message_text(
                     success_text,
@@ -396,63 +651,54 @@ class YooKassaBot:
                     parse_mode=ParseMode.HTML
                 )
                 
-            elif payment.status == 'pending':
+            elif payment['status'] == 'pending':
                 await query.answer("⏳ Платеж еще не прошел. Попробуйте позже.")
             else:
                 await query.answer("❌ Платеж не прошел или отменен")
                 
         except Exception as e:
-            logger.error(f"Ошибка проверки платежа: {e}")
+            logger.error("Ошибка проверки платежа: %s", e)
             await query.answer("❌ Ошибка проверки платежа")
 
     async def process_successful_payment(self, payment_id: str, order_id: str):
-        cursor = self.conn.cursor()
-
-        cursor.execute('''
-            SELECT o.user_id, o.tokens, o.price 
-            FROM orders o 
-            WHERE o.order_id = ? AND o.status != 'paid'
-        ''', (order_id,))
-        
-        order = cursor.fetchone()
-        
-        if not order:
-            return
-        
-        user_id, tokens, price = order
-
-        cursor.execute('''
-            UPDATE users 
-            SET tokens = tokens + ?, total_spent = total_spent + ? 
-            WHERE user_id = ?
-        ''', (tokens, price, user_id))
-
-        cursor.execute('''
-            UPDATE orders 
-            SET status = 'paid' 
-            WHERE order_id = ?
-        ''', (order_id,))
-
-        cursor.execute('''
-            UPDATE payments 
-            SET status = 'completed', updated = CURRENT_TIMESTAMP 
-            WHERE yookassa_id = ?
-        ''', (payment_id,))
-        
-        self.conn.commit()
+        async with self.transaction() as conn:
+            async with conn.execute('''
+                UPDATE orders 
+                SET status = 'paid' 
+                WHERE order_id = ? AND status != 'paid'
+                RETURNING user_id, tokens, price
+            ''', (order_id,)) as cursor:
+                order = await cursor.fetchone()
+
+            if not order:
+                return
+
+            user_id, tokens, price = order
+
+            async with conn.execute('''
+                UPDATE users 
+                SET tokens = tokens + ?, total_spent = total_spent + ? 
+                WHERE user_id = ?
+                RETURNING tokens, total_spent
+            ''', (tokens, price, user_id)) as cursor:
+                balance = await cursor.fetchone()
+
+            await conn.execute('''
+                UPDATE payments 
+                SET status = 'completed', updated = CURRENT_TIMESTAMP 
+                WHERE yookassa_id = ?
+            ''', (payment_id,))
+
+        if balance:
+            self.cache_user(user_id, balance)
 
         try:
-            user_info = self.get_user_info(user_id)
+            user_info = await self.get_user_info(user_id)
             if user_info:
-                keyboard = [
-                    [InlineKeyboardButton("📋 Главное меню", callback_data="menu")],
-                    [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
-                    [InlineKeyboardButton("🤖 Задать вопрос", callback_data="ask_question")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                reply_markup = self._kb_paid
                 
                 await self.application.bot.send_message(
-                    chat_id=int(user_id),
+                    chat_id=user_id,
                     text=f"🎉 <b>Токены зачислены!</b>\n\n"
                          f"✅ Получено: {tokens:,} токенов\n"
                          f"💰 Ваш баланс: {user_info['tokens']:,} токенов\n\n"
@@ -461,54 +707,69 @@ class YooKassaBot:
                     parse_mode=ParseMode.HTML
                 )
         except Exception as e:
-            logger.error(f"Ошибка отправки уведомления: {e}")
+            logger.error("Ошибка отправки уведомления: %s", e)
 
     async def check_pending_payments(self, context: CallbackContext):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT o.order_id, o.yookassa_payment_id 
-            FROM orders o 
-            WHERE o.status = 'created' 
-            AND datetime(o.created) > datetime('now', '-1 day')
-        ''')
-        
-        pending_orders = cursor.fetchall()
-        
-        for order_id, payment_id in pending_orders:
+        pending_orders = []
+        try:
+            async with self.conn.execute('''
+                SELECT o.order_id, o.yookassa_payment_id 
+                FROM orders o 
+                WHERE o.status = 'created' 
+                AND o.created > datetime('now', '-1 day')
+            ''') as cursor:
+                pending_orders = await cursor.fetchall()
+        finally:
+            # Следующая проверка планируется и при ошибке запроса, иначе цепочка run_once оборвется
+            if pending_orders:
+                self._poll_interval = self.POLL_INTERVAL_MIN
+            else:
+                self._poll_interval = min(self._poll_interval * 2, self.POLL_INTERVAL_MAX)
+            self.schedule_payment_check(self._poll_interval)
+
+        results = await asyncio.gather(
+            *[self.fetch_payment(payment_id) for _, payment_id in pending_orders],
+            return_exceptions=True
+        )
+
+        failed_orders = []
+        for (order_id, payment_id), payment in zip(pending_orders, results):
+            if isinstance(payment, Exception):
+                logger.error("Ошибка проверки платежа %s: %s", payment_id, payment)
+                continue
+
             try:
-                payment = Payment.find_one(payment_id)
-                
-                if payment.status == 'succeeded':
+                if payment['status'] == 'succeeded':
                     await self.process_successful_payment(payment_id, order_id)
-                    logger.info(f"Платеж {payment_id} подтвержден автоматически")
-                elif payment.status in ['canceled', 'failed']:
-                    cursor.execute('UPDATE orders SET status = ? WHERE order_id = ?', ('failed', order_id))
-                    cursor.execute('UPDATE payments SET status = ? WHERE yookassa_id = ?', ('failed', payment_id))
-                    self.conn.commit()
-                    
-            except Exception as e:
-                logger.error(f"Ошибка проверки платежа {payment_id}: {e}")
+                    logger.info("Платеж %s подтвержден автоматически", payment_id)
+                elif payment['status'] in ['canceled', 'failed']:
+                    failed_orders.append((order_id, payment_id))
 
-        cursor.execute('''
-            DELETE FROM orders 
-            WHERE status IN ('failed', 'canceled') 
-            AND datetime(created) < datetime('now', '-7 days')
-        ''')
-        self.conn.commit()
+            except Exception as e:
+                logger.error("Ошибка проверки платежа %s: %s", payment_id, e)
+
+        async with self.transaction() as conn:
+            await conn.executemany('UPDATE orders SET status = ? WHERE order_id = ?',
+                                   [('failed', order_id) for order_id, _ in failed_orders])
+            await conn.executemany('UPDATE payments SET status = ? WHERE yookassa_id = ?',
+                                   [('failed', payment_id) for _, payment_id in failed_orders])
+            await conn.execute('''
+                DELETE FROM orders 
+                WHERE status IN ('failed', 'canceled') 
+                AND created < datetime('now', '-7 days')
+            ''')
 
     async def payment_history(self, update: Update, context: CallbackContext):
-        user_id = str(update.effective_user.id)
+        user_id = update.effective_user.id
         
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        async with self.conn.execute('''
             SELECT amount, tokens_added, status, created, description 
             FROM payments 
             WHERE user_id = ? 
             ORDER BY created DESC 
             LIMIT 10
-        ''', (user_id,))
-        
-        payments = cursor.fetchall()
+        ''', (user_id,)) as cursor:
+            payments = await cursor.fetchall()
         
         if not payments:
             if update.message:
@@ -531,11 +792,7 @@ class YooKassaBot:
                 f"   Статус: {status_emoji} {status}\n\n"
             )
         
-        keyboard = [
-            [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
-            [InlineKeyboardButton("📋 Главное меню", callback_data="menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self._kb_history
 
         if update.message:
             await update.message.reply_text(history_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -543,11 +800,18 @@ class YooKassaBot:
             await update.callback_query.edit_message_text(history_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     async def handle_message(self, update: Update, context: CallbackContext):
-        user_message = update.message.text
-        user_id = str(update.effective_user.id)
+        user_id = update.effective_user.id
+
+        if not self.ollama_available:
+            await update.message.reply_text("❌ ИИ временно недоступен. Попробуйте позже.")
+            return
 
-        user_info = self.get_user_info(user_id)
-        if not user_info or user_info['tokens'] < self.COST_PER_REQUEST:
+        async with self.transaction() as conn:
+            async with conn.execute(self._sql_debit, (self.COST_PER_REQUEST, user_id, self.COST_PER_REQUEST)) as cursor:
+                row = await cursor.fetchone()
+
+        if row is None:
+            user_info = await self.get_user_info(user_id)
             await update.message.reply_text(
                 f"❌ <b>Недостаточно токенов!</b>\n\n"
                 f"💰 Ваш баланс: {user_info['tokens'] if user_info else 0} токенов\n"
@@ -557,18 +821,31 @@ class YooKassaBot:
             )
             return
 
-        if not self.ollama_available:
-            await update.message.reply_text("❌ ИИ временно недоступен. Попробуйте позже.")
-            return
+        user_info = self.cache_user(user_id, row)
 
-        await update.message.chat.send_action(action="typing")
-        
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('UPDATE users SET tokens = tokens - ? WHERE user_id = ?', (self.COST_PER_REQUEST, user_id))
-            self.conn.commit()
+            placeholder = await update.message.reply_text("🤔 Думаю над ответом...")
+            await self.infer_q.put((update.message, placeholder, user_id, user_info))
+        except BaseException:
+            await self.refund_request(user_id)
+            raise
+
+    async def inference_worker(self):
+        while True:
+            message, placeholder, user_id, user_info = await self.infer_q.get()
+            try:
+                await self.answer_message(message, placeholder, user_id, user_info)
+            except Exception as e:
+                logger.error("Ошибка в обработчике генерации: %s", e, exc_info=True)
+            finally:
+                self.infer_q.task_done()
 
-            history = self.conversation_history.get(user_id, [])
+    async def answer_message(self, message, placeholder, user_id: int, user_info: dict):
+        user_message = message.text
+        typing_task = asyncio.create_task(self.keep_typing(message.chat))
+        
+        try:
+            history = await self.load_history(user_id)
 
             system_prompt = """Ты - исключительно русскоязычный ассистент. Твои правила:
 
@@ -582,7 +859,7 @@ class YooKassaBot:
             context = ""
             if history:
                 context = "Контекст диалога:\n"
-                for role, msg in history[-3:]:
+                for role, msg in list(history)[-3:]:
                     speaker = "Пользователь" if role == 'user' else "Ассистент"
                     context += f"{speaker}: {msg}\n"
                 context += "\n"
@@ -594,65 +871,54 @@ class YooKassaBot:
 Помни: отвечай ТОЛЬКО на русском языке! Ответ:"""
             
             answer = ""
-            models_to_try = ['mistral', 'llama2', 'neural-chat', 'openchat']
+            models_to_try = [m for m in ['mistral', 'llama2', 'neural-chat', 'openchat'] if m in self.available_models]
+            models_to_try.sort(key=lambda m: m != self._last_good_model)
             
             for model in models_to_try:
+                cancel_event = threading.Event()
                 try:
-                    response = ollama.generate(
-                        model=model,
-                        prompt=full_prompt,
-                        options={
-                            'temperature': 0.3,
-                            'num_predict': 1000,
-                            'top_k': 40,
-                            'top_p': 0.9
-                        }
+                    answer = await asyncio.wait_for(
+                        asyncio.get_running_loop().run_in_executor(
+                            self._ollama_pool,
+                            functools.partial(self.generate_answer, model, full_prompt, cancel_event)
+                        ),
+                        timeout=self.OLLAMA_TIMEOUT
                     )
-                    answer = response['response'].strip()
+                    if answer is None:
+                        answer = ""
+                        continue
 
-                    russian_chars = set('абвгдеёжзийклмнопрстуфхцчшщъыьэюя')
-                    answer_chars = set(answer.lower())
-                    russian_ratio = len(answer_chars & russian_chars) / max(1, len(answer_chars))
+                    russian_count, english_count = count_letters(answer)
+                    russian_ratio = russian_count / max(1, russian_count + english_count)
                     
                     if russian_ratio > 0.5:  
-                        logger.info(f"✅ Успешно использована модель: {model}")
+                        logger.info("✅ Успешно использована модель: %s", model)
+                        self._last_good_model = model
                         break
                     else:
-                        logger.warning(f"⚠️ Модель {model} дала нерусский ответ, пробуем следующую...")
+                        logger.warning("⚠️ Модель %s дала нерусский ответ, пробуем следующую...", model)
                         answer = self.filter_english_text(answer)  
                         if len(answer.strip()) > 50:  
                             break
                         continue
                         
                 except Exception as e:
-                    logger.error(f"Ошибка с моделью {model}: {e}")
+                    logger.error("Ошибка с моделью %s: %s", model, e)
                     continue
 
+                finally:
+                    # wait_for не останавливает рабочий поток: по этому сигналу он закроет стрим генерации
+                    cancel_event.set()
+
             if not answer or len(answer.strip()) < 20:
                 answer = "Извините, в данный момент не могу дать качественный ответ на русском языке. Попробуйте перефразировать вопрос или обратитесь позже."
 
-            if user_id not in self.conversation_history:
-                self.conversation_history[user_id] = []
-            
-            self.conversation_history[user_id].append(('user', user_message))
-            self.conversation_history[user_id].append(('assistant', answer))
-
-            if len(self.conversation_history[user_id]) > 8:
-                self.conversation_history[user_id] = self.conversation_history[user_id][-8:]
+            await self.append_history(user_id, [('user', user_message), ('assistant', answer)])
 
-            user_info = self.get_user_info(user_id)
+            reply_markup = self._kb_answer
 
-            keyboard = [
-                [InlineKeyboardButton("💰 Баланс", callback_data="balance")],
-                [InlineKeyboardButton("🛒 Купить токены", callback_data="buy")],
-                [InlineKeyboardButton("🗑️ Очистить историю", callback_data="clear_history")],
-                [InlineKeyboardButton("🤖 Новый вопрос", callback_data="ask_question")],
-                [InlineKeyboardButton("📋 Главное меню", callback_data="menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            await update.message.reply_text(
-                f"{escape(answer)}\n\n"
+            await placeholder.edit_text(
+                f"{escape_html(answer)}\n\n"
                 f"💸 <b>Списано:</b> {self.COST_PER_REQUEST} токенов\n"
                 f"💰 <b>Баланс:</b> {user_info['tokens']:,} токенов",
                 reply_markup=reply_markup,
@@ -660,44 +926,110 @@ class YooKassaBot:
             )
             
         except Exception as e:
-            logger.error(f"Ошибка обработки сообщения: {e}", exc_info=True)
+            logger.error("Ошибка обработки сообщения: %s", e, exc_info=True)
 
-            cursor = self.conn.cursor()
-            cursor.execute('UPDATE users SET tokens = tokens + ? WHERE user_id = ?', (self.COST_PER_REQUEST, user_id))
-            self.conn.commit()
+            await self.refund_request(user_id)
             
-            await update.message.reply_text(
+            await placeholder.edit_text(
                 "❌ <b>Произошла ошибка</b>\n"
                 "💰 Токены были возвращены\n"
                 "Попробуйте еще раз или обратитесь в поддержку",
                 parse_mode=ParseMode.HTML
             )
 
+        except asyncio.CancelledError:
+            await self.abort_request(placeholder, user_id)
+            raise
+
+        finally:
+            typing_task.cancel()
+
+    async def stop_inference(self):
+        for task in self._inference_tasks:
+            task.cancel()
+        # Прерванные воркеры возвращают токены сами, запросы из очереди возвращаем здесь
+        await asyncio.gather(*self._inference_tasks, return_exceptions=True)
+        self._inference_tasks = []
+        while not self.infer_q.empty():
+            _, placeholder, user_id, _ = self.infer_q.get_nowait()
+            await self.abort_request(placeholder, user_id)
+
+    async def abort_request(self, placeholder, user_id: int):
+        try:
+            await self.refund_request(user_id)
+            await placeholder.edit_text(
+                "⏸️ <b>Бот перезапускается</b>\n"
+                "💰 Токены были возвращены\n"
+                "Отправьте вопрос еще раз чуть позже",
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            logger.error("Ошибка отмены запроса при остановке: %s", e)
+
+    async def refund_request(self, user_id: int):
+        async with self.transaction() as conn:
+            async with conn.execute(
+                'UPDATE users SET tokens = tokens + ? WHERE user_id = ? RETURNING tokens, total_spent',
+                (self.COST_PER_REQUEST, user_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if row:
+            self.cache_user(user_id, row)
+
+    def generate_answer(self, model: str, prompt: str, cancel_event: threading.Event) -> Optional[str]:
+        stream = ollama.generate(
+            model=model,
+            prompt=prompt,
+            stream=True,
+            options={
+                'temperature': 0.3,
+                'num_predict': 1000,
+                'top_k': 40,
+                'top_p': 0.9
+            }
+        )
+
+        parts = []
+        length = 0
+        checked = False
+        for chunk in stream:
+            if cancel_event.is_set():
+                stream.close()
+                return None
+
+            parts.append(chunk['response'])
+            length += len(chunk['response'])
+
+            if not checked and length >= 100:
+                checked = True
+                russian_count, english_count = count_letters(''.join(parts))
+                if russian_count / max(1, russian_count + english_count) < 0.5:
+                    logger.warning("⚠️ Модель %s начала отвечать не по-русски, генерация прервана", model)
+                    stream.close()
+                    return None
+
+        return ''.join(parts).strip()
+
+    async def keep_typing(self, chat):
+        try:
+            while True:
+                await chat.send_action(action="typing")
+                await asyncio.sleep(4)
+        except Exception as e:
+            logger.warning("Не удалось отправить статус набора: %s", e)
+
     def filter_english_text(self, text: str) -> str:
         if not text:
             return ""
 
         sentences = []
-        current_sentence = ""
-        
-        for char in text + " ": 
-            current_sentence += char
-            if char in '.!?':
-                russian_count = sum(1 for c in current_sentence if 'а' <= c.lower() <= 'я' or c == 'ё')
-                english_count = sum(1 for c in current_sentence if 'a' <= c.lower() <= 'z')
-                total_letters = russian_count + english_count
-                
-                if total_letters == 0 or russian_count / total_letters >= 0.7:  # 70% русских букв
-                    sentences.append(current_sentence.strip())
-                current_sentence = ""
 
-        if current_sentence.strip():
-            russian_count = sum(1 for c in current_sentence if 'а' <= c.lower() <= 'я' or c == 'ё')
-            english_count = sum(1 for c in current_sentence if 'a' <= c.lower() <= 'z')
+        for sentence in _SENTENCE_SPLIT_RE.split(text.strip()):
+            russian_count, english_count = count_letters(sentence)
             total_letters = russian_count + english_count
-            
-            if total_letters == 0 or russian_count / total_letters >= 0.7:
-                sentences.append(current_sentence.strip())
+
+            if total_letters == 0 or russian_count / total_letters >= 0.7:  # 70% русских букв
+                sentences.append(sentence)
         
         result = ' '.join(sentences)
 
@@ -709,95 +1041,245 @@ class YooKassaBot:
     async def button_handler(self, update: Update, context: CallbackContext):
         query = update.callback_query
         data = query.data
-        
+
+        handler = self._exact.get(data)
+        suffix = ""
+        if handler is None:
+            for prefix, prefix_handler in self._prefix:
+                if data.startswith(prefix):
+                    handler, suffix = prefix_handler, data[len(prefix):]
+                    break
+
+        if handler is None:
+            await query.answer(f"Неизвестная команда: {data}")
+            return
+
         try:
-            if data == "menu":
-                await query.answer()
-                await self.show_menu(update, context)
-            elif data == "balance":
-                await query.answer()
-                await self.show_balance(update, context)
-            elif data == "buy":
-                await query.answer()
-                await self.buy_tokens(update, context)
-            elif data == "history":
-                await query.answer()
-                await self.payment_history(update, context)
-            elif data == "help":
-                await query.answer()
-                await self.help_command(update, context)
-            elif data == "ask_question":
-                await query.answer("Напишите ваш вопрос в чат!")
-                await query.edit_message_text("💬 Напишите ваш вопрос в чат!")
-            elif data == "clear_history":
-                user_id = str(update.effective_user.id)
-                if user_id in self.conversation_history:
-                    del self.conversation_history[user_id]
-                    await query.answer("✅ История диалога очищена!")
-                    await query.edit_message_text("🗑️ История диалога очищена!")
-                else:
-                    await query.answer("📭 История диалога уже пуста!")
-            elif data.startswith("create_payment_"):
-                pack_id = data.split("_")[2]
-                await self.create_yookassa_payment(update, pack_id)
-            elif data.startswith("check_payment_"):
-                order_id = data.split("_")[2]
-                await self.check_payment_status(update, order_id)
-            elif data.startswith("cancel_order_"):
-                order_id = data.split("_")[2]
-                await query.answer("Заказ отменен")
-                await query.edit_message_text("❌ Заказ отменен")
-            else:
-                await query.answer(f"Неизвестная команда: {data}")
+            await handler(update, context, query, suffix)
         except Exception as e:
-            logger.error(f"Ошибка в обработчике кнопок: {e}")
-            await query.answer("❌ Произошла ошибка, попробуйте позже")
-
-    def register_user(self, user_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO users (user_id, tokens) VALUES (?, 100)', (user_id,))
-        self.conn.commit()
-
-    def get_user_info(self, user_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT tokens, total_spent FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            return {
-                'tokens': result[0],
-                'total_spent': result[1]
-            }
-        return None
+            logger.error("Ошибка в обработчике кнопок: %s", e)
+            # Обработчик мог уже ответить на запрос — повторный answer вернет BadRequest
+            with suppress(BadRequest):
+                await query.answer("❌ Произошла ошибка, попробуйте позже")
 
-    def run(self):
-        logger.info("Бот с YooKassa запущен!")
-        logger.info(f"Пакеты токенов: {len(self.token_packs)}")
-        logger.info(f"Ollama: {'Доступен' if self.ollama_available else 'Недоступен'}")
+    async def _menu_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer()
+        await self.show_menu(update, context)
+
+    async def _balance_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer()
+        await self.show_balance(update, context)
+
+    async def _buy_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer()
+        await self.buy_tokens(update, context)
+
+    async def _history_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer()
+        await self.payment_history(update, context)
+
+    async def _help_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer()
+        await query.message.reply_text(_HELP_TEXT, parse_mode=ParseMode.HTML)
 
+    async def _ask_question_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await query.answer("Напишите ваш вопрос в чат!")
+        await query.edit_message_text("💬 Напишите ваш вопрос в чат!")
+
+    async def _clear_history_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        user_id = update.effective_user.id
+        if await self.clear_user_history(user_id):
+            await query.answer("✅ История диалога очищена!")
+        else:
+            await query.answer("📭 История диалога уже пуста!")
+
+    async def _create_payment_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await self.create_yookassa_payment(update, suffix)
+
+    async def _check_payment_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        await self.check_payment_status(update, suffix)
+
+    async def _cancel_order_cb(self, update: Update, context: CallbackContext, query, suffix: str):
+        rows = await self.conn.execute_fetchall(
+            'SELECT status FROM orders WHERE order_id = ? AND user_id = ?',
+            (suffix, update.effective_user.id)
+        )
+
+        if not rows:
+            await query.answer("❌ Заказ не найден")
+        elif rows[0][0] == 'paid':
+            await query.answer("✅ Платеж уже подтвержден")
+        else:
+            await query.answer()
+            await query.edit_message_text("❌ Заказ отменен")
+
+    async def register_user(self, user_id: int):
+        future = asyncio.get_running_loop().create_future()
+        await self._register_queue.put((user_id, future))
+        await future
+        self._user_cache.pop(user_id, None)
+
+    async def register_writer(self):
+        while True:
+            batch = [await self._register_queue.get()]
+            while len(batch) < 100 and not self._register_queue.empty():
+                batch.append(self._register_queue.get_nowait())
+
+            try:
+                async with self.transaction() as conn:
+                    await conn.executemany(self._sql_register_user, [(user_id,) for user_id, _ in batch])
+            except Exception as e:
+                logger.error("Ошибка регистрации пользователей: %s", e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def get_user_info(self, user_id: int):
+        user_info = self._user_cache.get(user_id)
+        if user_info is not None:
+            self._user_cache.move_to_end(user_id)
+            return user_info
+
+        rows = await self.conn.execute_fetchall(self._sql_user_info, (user_id,))
         
-        self.application.run_polling()
+        if rows:
+            # Запись, завершившаяся во время чтения, уже положила в кэш более свежие данные
+            if user_id in self._user_cache:
+                return self._user_cache[user_id]
+            return self.cache_user(user_id, rows[0])
+        return None
 
+    async def load_history(self, user_id: int):
+        history = self.conversation_history.get(user_id)
+        if history is not None:
+            self.conversation_history.move_to_end(user_id)
+            return history
+
+        rows = await self.conn.execute_fetchall('''
+            SELECT h.role, p.text 
+            FROM history h 
+            JOIN prompts p ON p.hash = h.prompt_hash 
+            WHERE h.user_id = ? 
+            ORDER BY h.ts DESC 
+            LIMIT ?
+        ''', (user_id, self.HISTORY_LIMIT))
+
+        history = self.conversation_history.get(user_id)
+        if history is None:
+            history = deque(reversed(rows), maxlen=self.HISTORY_LIMIT)
+            self.conversation_history[user_id] = history
+            if len(self.conversation_history) > self.HISTORY_CACHE_SIZE:
+                self.conversation_history.popitem(last=False)
+        return history
+
+    async def append_history(self, user_id: int, turns):
+        history = await self.load_history(user_id)
+        history.extend(turns)
+
+        now = time.time_ns()
+        hashes = [content_hash(content) for _, content in turns]
+        async with self.transaction() as conn:
+            await conn.executemany(
+                'INSERT OR IGNORE INTO prompts (hash, text) VALUES (?, ?)',
+                [(h, content) for h, (_, content) in zip(hashes, turns)]
+            )
+            await conn.executemany(
+                'INSERT INTO history (user_id, ts, role, prompt_hash) VALUES (?, ?, ?, ?)',
+                [(user_id, now + i, role, h) for i, (h, (role, _)) in enumerate(zip(hashes, turns))]
+            )
+            async with conn.execute('''
+                DELETE FROM history 
+                WHERE user_id = ? AND ts < (
+                    SELECT ts FROM history 
+                    WHERE user_id = ? 
+                    ORDER BY ts DESC 
+                    LIMIT 1 OFFSET ?
+                )
+                RETURNING prompt_hash
+            ''', (user_id, user_id, self.HISTORY_LIMIT - 1)) as cursor:
+                trimmed = await cursor.fetchall()
+            await self.delete_orphan_prompts(conn, trimmed)
+
+    async def clear_user_history(self, user_id: int) -> bool:
+        self.conversation_history.pop(user_id, None)
+        async with self.transaction() as conn:
+            async with conn.execute('DELETE FROM history WHERE user_id = ? RETURNING prompt_hash', (user_id,)) as cursor:
+                deleted = await cursor.fetchall()
+            await self.delete_orphan_prompts(conn, deleted)
+        return bool(deleted)
+
+    async def delete_orphan_prompts(self, conn, rows):
+        await conn.executemany('''
+            DELETE FROM prompts 
+            WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM history h WHERE h.prompt_hash = prompts.hash)
+        ''', {(prompt_hash,) for prompt_hash, in rows})
+
+    def cache_user(self, user_id: int, row):
+        user_info = {
+            'tokens': row[0],
+            'total_spent': row[1]
+        }
+        self._user_cache[user_id] = user_info
+        self._user_cache.move_to_end(user_id)
+        if len(self._user_cache) > self.USER_CACHE_SIZE:
+            self._user_cache.popitem(last=False)
+        return user_info
+
+    async def run(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # На Windows остановка идет через KeyboardInterrupt
+                pass
 
-def main():
-    from pathlib import Path
-    
-    env_path = Path('.') / '.env'
-    if not env_path.exists():
+        try:
+            await self.application.initialize()
+            await self.post_init(self.application)
+
+            logger.info("Бот с YooKassa запущен!")
+            logger.info("Пакеты токенов: %s", len(self.token_packs))
+            logger.info("Ollama: %s", 'Доступен' if self.ollama_available else 'Недоступен')
+
+            await self.application.updater.start_polling()
+            await self.application.start()
+            await stop_event.wait()
+        finally:
+            if self.application.updater.running:
+                await self.application.updater.stop()
+            if self.application.running:
+                await self.application.stop()
+            # До shutdown клиент бота еще открыт и может обновить сообщения-заглушки
+            await self.stop_inference()
+            await self.application.shutdown()
+            await self.post_shutdown(self.application)
+
+
+async def main():
+    if not os.path.exists(".env"):
         print("Файл .env не найден")
     
     load_dotenv()
     
     TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-    if not TELEGRAM_TOKEN or TELEGRAM_TOKEN == "ваш_токен_бота":
-        print("ELEGRAM_TOKEN не установлен или установлен по умолчанию")
+    if not _TOKEN_RE.match(TELEGRAM_TOKEN or ""):
+        print("TELEGRAM_TOKEN не установлен или имеет неверный формат")
         return
     
     if not os.getenv('YOOKASSA_SHOP_ID') or not os.getenv('YOOKASSA_SECRET_KEY'):
         print("Данные YooKassa не настроены")
 
     bot = YooKassaBot(TELEGRAM_TOKEN)
-    bot.run()
+    await bot.run()
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file